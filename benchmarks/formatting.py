@@ -0,0 +1,239 @@
+''' Measure how long each step of formatting takes on a generated corpus.
+
+The corpus covers code that has been slow to format: deeply nested literals,
+thousands of lines inside a deep literal, very long functions, comment heavy
+modules, long hanging indent call chains and backslash continuations.  For
+each sample the token stream construction, each reformat pass, the AST check,
+the pep8 check and the diff are timed separately, taking the fastest of
+several runs.
+
+Results can be saved and later runs compared with them, exiting with an error
+if any step got slower by more than the threshold.
+
+    python benchmarks/formatting.py [--runs N] [--save FILE]
+                                    [--baseline FILE] [--threshold PERCENT]
+'''
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import peprika  # noqa
+
+
+def nested_literals(depth=10, width=4):
+    ''' Module level literals nested depth deep with an item per line. '''
+    def literal(level, indent):
+        if not level:
+            return '1'
+        inner = literal(level - 1, indent + 4)
+        if level % 3 == 0:
+            items = ["'k%d':%s" % (i, inner) for i in range(2)]
+            brackets = '{}'
+        elif level % 3 == 1:
+            items = [inner] * 2
+            brackets = '[]'
+        else:
+            items = [inner] * 2
+            brackets = '()'
+        return '%s\n%s%s\n%s%s' % (
+            brackets[0], ' ' * (indent + 4),
+            (',\n' + ' ' * (indent + 4)).join(items), ' ' * indent,
+            brackets[1])
+    lines = []
+    for i in range(width):
+        lines.append('DATA_%d=%s\n' % (i, literal(depth - i, 0)))
+    return ''.join(lines)
+
+
+def deep_literal(depth=50, items=10000):
+    ''' Ten thousand lines inside a literal nested depth deep. '''
+    lines = ['DEEP=']
+    for level in range(depth):
+        lines.append('%s[\n' % (' ' * (level * 4)))
+    for i in range(items):
+        lines.append('%s%d,\n' % (' ' * (depth * 4), i))
+    for level in reversed(range(depth)):
+        lines.append('%s]%s\n' % (' ' * (level * 4), ',' if level else ''))
+    return ''.join(lines)
+
+
+def long_function(statements=1000):
+    ''' A single function with a thousand lines of statements. '''
+    lines = ['def process(items,total=0):\n']
+    for i in range(statements):
+        if i % 10 == 0:
+            lines.append('    if total>%d:\n' % i)
+            lines.append('        total=total-items[%d]\n' % (i % 7))
+        else:
+            lines.append('    total+=items[%d]*%d\n' % (i % 7, i))
+    lines.append('    return total\n')
+    return ''.join(lines)
+
+
+def comment_heavy(blocks=300):
+    ''' A module with more comments than code. '''
+    lines = []
+    for i in range(blocks):
+        lines.append('#comment describing value %d\n' % i)
+        lines.append('#    that goes on for a second line\n')
+        lines.append('value_%d=%d #inline comment\n' % (i, i))
+        lines.append('if value_%d:\n' % i)
+        lines.append('  # comment before an indent\n')
+        lines.append('  value_%d+=1\n' % i)
+        lines.append('# comment after a dedent\n')
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def call_chains(chains=200, length=8):
+    ''' Long method call chains broken over hanging indents. '''
+    lines = []
+    for i in range(chains):
+        lines.append('result_%d=(query(\n' % i)
+        for j in range(length):
+            lines.append('        ).method_%d(argument_%d,\n' % (j, j))
+            lines.append('                    key=%d,\n' % j)
+            lines.append('                    other=[%d,%d]\n' % (i, j))
+        lines.append('        ))\n')
+    return ''.join(lines)
+
+
+def backslash_continuations(statements=500):
+    ''' Statements continued over several lines with backslashes. '''
+    lines = []
+    for i in range(statements):
+        lines.append('total_%d=first+\\\n' % i)
+        lines.append('    second*%d+\\\n' % i)
+        lines.append('    third\n')
+        lines.append('assert total_%d, \\\n' % i)
+        lines.append('       "message"\n')
+    return ''.join(lines)
+
+
+CORPUS = [
+    ('nested literals', nested_literals),
+    ('deep literal', deep_literal),
+    ('long function', long_function),
+    ('comment heavy', comment_heavy),
+    ('call chains', call_chains),
+    ('backslashes', backslash_continuations),
+]
+
+
+def best_of(runs, func, *args):
+    ''' Fastest time in seconds to call the function and its result. '''
+    best = None
+    for i in range(runs):
+        start = time.time()
+        result = func(*args)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best, result
+
+
+def reformat_passes(formatter, lines, runs):
+    ''' Time each reformat pass until the output stops changing. '''
+    timings = []
+    source = lines
+    for i in range(formatter.options.max_passes):
+        taken, out = best_of(runs, formatter.reformat, source)
+        timings.append(('pass %d' % (i + 1), taken))
+        if out == source:
+            break
+        source = out
+    return timings, out
+
+
+def check_ast(source, out):
+    ''' If the reformatted code has the same meaning. '''
+    return peprika.same_ast(ast.parse(source), ast.parse(''.join(out)))
+
+
+def measure(name, source, runs):
+    ''' Time the formatting steps for a sample.  Returns the steps with their
+    times and the number of lines and tokens. '''
+    lines = source.splitlines(True)
+    formatter = peprika.Peprika(peprika.Options())
+    timings = []
+
+    taken, stream = best_of(runs, peprika.Stream, lines)
+    timings.append(('stream', taken))
+    passes, out = reformat_passes(formatter, lines, runs)
+    timings.extend(passes)
+    taken, same = best_of(runs, check_ast, source, out)
+    if not same:
+        sys.exit('Reformatting %s changed its meaning' % name)
+    timings.append(('ast', taken))
+    try:
+        import pep8  # noqa
+    except ImportError:
+        pass
+    else:
+        timings.append(('pep8', best_of(runs, formatter.check_pep8,
+                                        None, out)[0]))
+    timings.append(('diff', best_of(runs, peprika.diff_counts,
+                                    lines, out)[0]))
+    return timings, len(lines), stream.length
+
+
+def compare(results, baseline, threshold):
+    ''' Print the steps slower than the baseline by more than the threshold
+    percentage and return if there were any. '''
+    slower = False
+    for name, steps in sorted(results.items()):
+        for step, taken in sorted(steps.items()):
+            before = baseline.get(name, {}).get(step)
+            if not before:
+                continue
+            change = (taken - before) / before * 100
+            if change > threshold:
+                slower = True
+                print '%-16s %-8s %8.1fms -> %8.1fms %+6.1f%% SLOWER' % (
+                    name, step, before * 1000, taken * 1000, change)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as json')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved earlier')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percentage slower than the baseline allowed')
+    args = parser.parse_args()
+
+    results = {}
+    for name, generate in CORPUS:
+        timings, lines, tokens = measure(name, generate(), args.runs)
+        results[name] = dict(timings)
+        formatting = sum(taken for step, taken in timings
+                         if step.startswith('pass'))
+        print '%s: %d lines %d tokens, %d lines/s %d tokens/s' % (
+            name, lines, tokens, lines / formatting, tokens / formatting)
+        for step, taken in timings:
+            print '    %-8s %8.1fms' % (step, taken * 1000)
+
+    if args.save:
+        f = open(args.save, 'w')
+        json.dump(results, f, indent=4, sort_keys=True)
+        f.close()
+    if args.baseline:
+        f = open(args.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+        if compare(results, baseline, args.threshold):
+            sys.exit('Slower than the baseline by more than %s%%'
+                     % args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+''' Measure the cold start time of the peprika command.
+
+Each flag combination is run several times in a fresh interpreter on a small
+generated file and the fastest run is compared with the time taken to start
+an interpreter that does nothing.  Exits with an error if any combination
+takes longer than the budget over that.
+
+    python benchmarks/startup.py [--runs N] [--budget MS]
+'''
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = '''import os
+
+
+def main(argv):
+    for name in argv:
+        print os.path.basename(name)
+'''
+
+# flag combinations to time, the sample file is added to each
+COMBINATIONS = [
+    ['--no-pep8', '--fix'],
+    ['--no-pep8', '--output'],
+    ['--no-pep8', '--client'],
+    ['--fix'],
+    ['--diff'],
+]
+
+
+def run(args, runs, cwd):
+    ''' Fastest time in seconds to run the python arguments. '''
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, cwd=cwd,
+                              stdout=open(os.devnull, 'w'))
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=150,
+                        help='allowed milliseconds over a bare interpreter')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        sample = os.path.join(directory, 'sample.py')
+        socket = os.path.join(directory, 'none.sock')
+        command = ('import sys; sys.path.insert(0, %r); import peprika; '
+                   'sys.argv[0] = "peprika"; peprika.main()' % ROOT)
+
+        bare = run(['-c', 'pass'], args.runs, directory)
+        print '%-30s %7.1fms' % ('interpreter', bare * 1000)
+
+        timings = [('import peprika',
+                    run(['-c', 'import sys; sys.path.insert(0, %r); '
+                         'import peprika' % ROOT], args.runs, directory))]
+        for flags in COMBINATIONS:
+            # start each run with the unformatted file
+            f = open(sample, 'w')
+            f.write(SAMPLE)
+            f.close()
+            argv = ['-c', command, '--socket', socket] + flags + [sample]
+            timings.append((' '.join(flags), run(argv, args.runs, directory)))
+    finally:
+        shutil.rmtree(directory)
+
+    failed = False
+    for name, taken in timings:
+        over = (taken - bare) * 1000
+        status = 'ok'
+        if over > args.budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print '%-30s %7.1fms +%6.1fms %s' % (name, taken * 1000, over,
+                                             status)
+    if failed:
+        sys.exit('Start up is over the %sms budget' % args.budget)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,17 @@
+import bisect
 import cStringIO
 import sys
 import os
-import ast
+import errno
 from keyword import iskeyword
 import re
 import tokenize
-import difflib
-import textwrap
+import time
 
-from colorama import Fore, Back
-import pep8
+# Other modules are imported where they are used to keep start up fast for
+# runs that do not need them.
+
+__version__ = '0.1'
 
 INDENT_SIZE = 4
 MAX_LINE_LEN = 79
@@ -18,23 +20,243 @@ NEWLINE = '\n'
 BASIC_TOKENS = [tokenize.NAME, tokenize.STRING, tokenize.NUMBER]
 
 
+def same_ast(tree, other):
+    ''' Compare two abstract syntax trees in the same way as comparing their
+    ast.dump() would, stopping at the first difference. '''
+    import ast
+    pending = [(tree, other)]
+    while pending:
+        node, other = pending.pop()
+        if isinstance(node, ast.AST):
+            if type(node) is not type(other):
+                return False
+            for field in node._fields:
+                pending.append((getattr(node, field, None),
+                                getattr(other, field, None)))
+        elif isinstance(node, list):
+            if not isinstance(other, list) or len(node) != len(other):
+                return False
+            pending.extend(zip(node, other))
+        elif type(node) is not type(other) or node != other:
+            return False
+    return True
+
+
+def statement_starts(tree, length):
+    ''' Line numbers where the top level statements of the parsed code start
+    followed by one past its last line.  Statements starting with a
+    multi-line string have no reliable line number (their col_offset is -1)
+    so stay part of the previous one. '''
+    starts = [1]
+    for node in tree.body:
+        if node.col_offset != -1 and node.lineno > starts[-1]:
+            starts.append(node.lineno)
+    starts.append(length + 1)
+    return starts
+
+
+def nested_statement_starts(tree, length):
+    ''' Line numbers where the statements of the parsed code start, at any
+    depth and including except clauses, followed by one past its last line.
+    Also the index of the start of the statement each is nested in, or None.
+    As for statement_starts statements with no reliable line number, or
+    starting on the line of the one before, stay part of the one before. '''
+    import ast
+
+    starts = [1]
+    parents = [None]
+    pending = [(node, None) for node in reversed(tree.body)]
+    while pending:
+        node, parent = pending.pop()
+        if node.col_offset != -1 and node.lineno > starts[-1]:
+            starts.append(node.lineno)
+            parents.append(parent)
+        index = len(starts) - 1
+        children = [child for child in ast.iter_child_nodes(node)
+                    if isinstance(child, (ast.stmt, ast.excepthandler))]
+        pending.extend((child, index) for child in reversed(children))
+    starts.append(length + 1)
+    return starts, parents
+
+
+def common_affixes(origional, current):
+    ''' Number of lines the two lists share at their start and at their end.
+    The two never overlap. '''
+    limit = min(len(origional), len(current))
+    prefix = 0
+    while prefix < limit and origional[prefix] == current[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while (suffix < limit and
+           origional[-1 - suffix] == current[-1 - suffix]):
+        suffix += 1
+    return prefix, suffix
+
+
+def changed_blocks(origional, current):
+    ''' The blocks of lines that differ between origional and current as
+    sorted (start, end, current_start, current_end) slice indexes without
+    building any diff text.  After trimming the shared start and end lines
+    are matched by hash, lines appearing once in each side anchor the match
+    (the longest run of them in the same order) and the gaps between
+    anchors are compared in the same way. '''
+    blocks = []
+    todo = [(0, len(origional), 0, len(current))]
+    while todo:
+        a_lo, a_hi, b_lo, b_hi = todo.pop()
+        while (a_lo < a_hi and b_lo < b_hi and
+               origional[a_lo] == current[b_lo]):
+            a_lo += 1
+            b_lo += 1
+        while (a_lo < a_hi and b_lo < b_hi and
+               origional[a_hi - 1] == current[b_hi - 1]):
+            a_hi -= 1
+            b_hi -= 1
+        if a_lo == a_hi or b_lo == b_hi:
+            if a_lo != a_hi or b_lo != b_hi:
+                blocks.append((a_lo, a_hi, b_lo, b_hi))
+            continue
+        # lines seen more than once map to None
+        unique_a = {}
+        for i in xrange(a_lo, a_hi):
+            line = origional[i]
+            unique_a[line] = None if line in unique_a else i
+        unique_b = {}
+        for j in xrange(b_lo, b_hi):
+            line = current[j]
+            if unique_a.get(line) is not None:
+                unique_b[line] = None if line in unique_b else j
+        pairs = sorted((unique_a[line], j)
+                       for line, j in unique_b.iteritems() if j is not None)
+        if not pairs:
+            blocks.append((a_lo, a_hi, b_lo, b_hi))
+            continue
+        # longest increasing run of positions in current (patience sorting)
+        tails = []
+        tail_pairs = []
+        previous = []
+        for index, (i, j) in enumerate(pairs):
+            pile = bisect.bisect_left(tails, j)
+            if pile == len(tails):
+                tails.append(j)
+                tail_pairs.append(index)
+            else:
+                tails[pile] = j
+                tail_pairs[pile] = index
+            previous.append(tail_pairs[pile - 1] if pile else None)
+        index = tail_pairs[-1]
+        while index is not None:
+            i, j = pairs[index]
+            todo.append((i + 1, a_hi, j + 1, b_hi))
+            a_hi, b_hi = i, j
+            index = previous[index]
+        todo.append((a_lo, a_hi, b_lo, b_hi))
+    blocks.sort()
+    return blocks
+
+
+def diff_counts(origional, current):
+    ''' Count the lines deleted from and added to origional to give current
+    without building any diff text. '''
+    deleted = added = 0
+    for a_lo, a_hi, b_lo, b_hi in changed_blocks(origional, current):
+        deleted += a_hi - a_lo
+        added += b_hi - b_lo
+    return deleted, added
+
+
+class Token(object):
+    ''' A single item of the token stream.  Items can also be indexed by
+    attribute name eg token['value']. '''
+
+    __slots__ = ('type', 'value', 'line', 'start', 'end')
+
+    def __init__(self, t_type, value, line, start, end):
+        self.type = t_type
+        self.value = value
+        self.line = line
+        self.start = start
+        self.end = end
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class Output(list):
+    ''' Lines of reformatted code.  Lines are altered in place so that
+    building the output never copies it. '''
+
+    def amend_last(self, line):
+        ''' Replace the last line. '''
+        self[-1] = line
+
+    def trim_blank_line(self):
+        ''' Remove the last line if it is blank. '''
+        if self and not self[-1].strip():
+            self.pop()
+
+    def encode(self, encoding='utf-8'):
+        ''' Encode the lines in place. '''
+        for index, line in enumerate(self):
+            self[index] = line.encode(encoding)
+        return self
+
+
 class Stream(object):
 
-    def __init__(self, source):
-        # Create our stream to allow looking ahead of our current line
-        stream = []
-        s = cStringIO.StringIO(''.join(source))
-        tokgen = tokenize.generate_tokens(s.readline)
-        for t_type, t_value, start, end, t_line in tokgen:
-            stream.append({
-                'type': t_type,
-                'value': t_value.decode('utf-8'),
-                'line': t_line,
-                'start': start,
-                'end': end,
-            })
-        self.stream = stream
-        self.length = len(stream)
+    # When streaming, how many processed items to collect before dropping
+    # them from the buffer.
+    TRIM_SIZE = 1024
+    # Returned for items before the start of the stream when streaming.
+    START = Token(tokenize.ENDMARKER, u'', '', (0, 0), (0, 0))
+
+    def __init__(self, source, streaming=False, encoding='utf-8',
+                 whole_lines=False):
+        # Create our stream to allow looking ahead of our current line.
+        # When streaming, tokens are only read as far as lookaheads need and
+        # processed ones are dropped so the buffer stays small.  Token values
+        # are decoded from the encoding, if it is None the source is already
+        # unicode.  If each item of the source is known to be a single line
+        # they are tokenized in place rather than joined and split again so
+        # the tokens share the lines.
+        if streaming or whole_lines:
+            readline = iter(source).next
+        elif encoding is None:
+            import io
+            readline = io.StringIO(u''.join(source), newline=NEWLINE).readline
+        else:
+            readline = cStringIO.StringIO(''.join(source)).readline
+        self.encoding = encoding
+        self._tokgen = tokenize.generate_tokens(readline)
+        self.streaming = streaming
+        self.stream = []
+        self._base = 0  # stream index of the first buffered item
+        self.length = 0  # number of items read so far
+        # Map the index of each opening bracket to its closing one so that
+        # lookaheads do not need to rescan the stream.
+        self.closers = {}
+        self._openers = []
+        # First and last index of the tokens starting on each physical line.
+        self.line_first = {}
+        self.line_last = {}
+        self._row = None
+        # For each buffered item whether an opening op between it and the
+        # end of its physical line is not closed on that line.
+        self.unclosed = []
+        # For each buffered item if the logical line it belongs to ends with
+        # a colon, known once the NEWLINE ending the line has been read.
+        self.colon = []
+        self._logical_start = 0
+        # For each buffered item the net change of indent from it to the
+        # first code after any comments, blank lines and dedents.  Known
+        # once that code has been read and kept for scans that stop at the
+        # second blank line in a row, the same after a blank line and ones
+        # that do not stop at blank lines.
+        self.indents = []
+        self._indents_start = None
+        # Share the decoded value between identical tokens.
+        self._values = {}
         self._offset = 0
         self.l_type = None
         self.l_value = None
@@ -43,12 +265,185 @@ class Stream(object):
         self.t_value = None
         self.t_end = (0, 0)
         self._block_update = False
+        if not streaming:
+            self._fill()
+
+    def _read(self):
+        ''' Read the next token into the buffer. '''
+        if self._tokgen is None:
+            return False
+        try:
+            t_type, t_value, start, end, t_line = self._tokgen.next()
+        except StopIteration:
+            self._tokgen = None
+            self._close_line()
+            self._close_indents(self.length, (0, 0, 0))
+            return False
+        index = self.length
+        if t_type == tokenize.OP:
+            if t_value in ('(', '{', '['):
+                self._openers.append(index)
+            elif t_value in (')', '}', ']') and self._openers:
+                self.closers[self._openers.pop()] = index
+        row = start[0]
+        if row != self._row:
+            self._close_line()
+            self._row = row
+            self.line_first[row] = index
+        self.line_last[row] = index
+        value = self._values.get(t_value)
+        if value is None:
+            value = t_value
+            if self.encoding:
+                value = value.decode(self.encoding)
+            self._values[t_value] = value
+        self.stream.append(Token(t_type, value, t_line, start, end))
+        self.unclosed.append(False)
+        self.colon.append(None)
+        if t_type in (tokenize.NL, tokenize.COMMENT, tokenize.DEDENT):
+            self.indents.append(None)
+            if self._indents_start is None:
+                self._indents_start = index
+        else:
+            following = (1, 1, 1) if t_type == tokenize.INDENT else (0, 0, 0)
+            self.indents.append(following)
+            self._close_indents(index, following)
+        self.length += 1
+        if t_type == tokenize.NEWLINE:
+            self._close_logical_line()
+        return True
+
+    def _close_logical_line(self):
+        ''' The NEWLINE ending a logical line has been read so record for
+        the line's items if it ends with a colon. '''
+        base = self._base
+        end = self.length - 1
+        colon = self.stream[end - base - 1].value == ':'
+        for index in xrange(max(self._logical_start, base), end + 1):
+            self.colon[index - base] = colon
+        self._logical_start = end + 1
+
+    def _close_indents(self, end, following):
+        ''' The item at end follows a run of comments, blank lines and
+        dedents so work out the indent changes from each of them. '''
+        start = self._indents_start
+        if start is None:
+            return
+        base = self._base
+        for index in xrange(end - 1, max(start, base) - 1, -1):
+            t_type = self.stream[index - base].type
+            stop, after_nl, through = following
+            if t_type == tokenize.DEDENT:
+                following = (stop - 1, after_nl - 1, through - 1)
+            elif t_type == tokenize.COMMENT:
+                following = (stop, stop, through)
+            else:
+                following = (after_nl, 0, through)
+            self.indents[index - base] = following
+        self._indents_start = None
+
+    def _close_line(self):
+        ''' The last physical line has been fully read so record which of
+        its items are followed by an opening op left open on the line. '''
+        row = self._row
+        if row is None:
+            return
+        base = self._base
+        closing = 0
+        unclosed = False
+        for index in xrange(self.line_last[row], self.line_first[row] - 1, -1):
+            value = self.stream[index - base].value
+            if value in (')', '}', ']'):
+                closing += 1
+            elif value in ('(', '{', '['):
+                if closing:
+                    closing -= 1
+                else:
+                    unclosed = True
+            self.unclosed[index - base] = unclosed
+
+    def _fill(self, index=None):
+        ''' Read ahead until the item at index is available or the source
+        is exhausted. '''
+        while (index is None or index >= self.length) and self._read():
+            pass
+
+    def _trim(self):
+        ''' Drop processed items that lookbehinds can no longer need. '''
+        current = self._offset - 1
+        row = self._get(current).start[0]
+        keep = min(current - 2, self.line_first[row] - 1)
+        if keep - self._base < self.TRIM_SIZE:
+            return
+        drop = keep - self._base
+        del self.stream[:drop]
+        del self.unclosed[:drop]
+        del self.colon[:drop]
+        del self.indents[:drop]
+        self._base = keep
+        for opener in [k for k in self.closers if k < keep]:
+            del self.closers[opener]
+        for row in [k for k in self.line_last if self.line_last[k] < keep]:
+            del self.line_first[row]
+            del self.line_last[row]
+
+    def _get(self, index):
+        ''' Get the stream item at index reading ahead if needed. '''
+        if index >= self.length:
+            self._fill(index)
+        if index < 0 and self.streaming:
+            return self.START
+        return self.stream[index - self._base]
+
+    def _closer(self, index):
+        ''' Get the index of the closing op matching the opening op at
+        index. '''
+        while index not in self.closers and self._read():
+            pass
+        return self.closers[index]
+
+    def _line_last(self, row):
+        ''' Get the index of the last item starting on the physical line.
+        '''
+        while row == self._row and self._read():
+            pass
+        return self.line_last[row]
+
+    def logical_line_colon(self, offset=0):
+        ''' Does the logical line that the stream item relative to the
+        current one belongs to end with a colon.  False if no NEWLINE follows
+        it. '''
+        index = max(self._offset + offset - 1, 0)
+        while ((index >= self.length
+                or self.colon[index - self._base] is None)
+               and self._read()):
+            pass
+        if index >= self.length:
+            return False
+        return self.colon[index - self._base]
+
+    def indent_change(self, offset=0, break_on_nl=True):
+        ''' The net change of indent from the stream item relative to the
+        current one to the first code after any comments, blank lines and
+        dedents.  If break_on_nl a second blank line in a row stops it
+        early. '''
+        index = self._offset + offset - 1
+        while ((index >= self.length
+                or self.indents[index - self._base] is None)
+               and self._read()):
+            pass
+        if index >= self.length or (index < 0 and self.streaming):
+            return 0
+        return self.indents[index - self._base][0 if break_on_nl else 2]
 
     def offset(self, offset=0):
         ''' Get the stream item relative to the one currently being
         processed. '''
+        index = self._offset + offset - 1
+        if self._base <= index < self.length:
+            return self.stream[index - self._base]
         try:
-            return self.stream[self._offset + offset - 1]
+            return self._get(index)
         except IndexError:
             return (None, '', False)
 
@@ -56,6 +451,8 @@ class Stream(object):
         return self
 
     def next(self):
+        if self._offset >= self.length:
+            self._fill(self._offset)
         if self._offset < self.length:
 
             self.l_type = self.t_type
@@ -64,14 +461,16 @@ class Stream(object):
                 self.l_line_no = self.t_end[0]
             self._block_update = False
 
-            stream_item = self.stream[self._offset]
+            stream_item = self.stream[self._offset - self._base]
 
-            self.t_type = stream_item['type']
-            self.t_value = stream_item['value']
-            self.t_line = stream_item['line']
-            self.t_start = stream_item['start']
-            self.t_end = stream_item['end']
+            self.t_type = stream_item.type
+            self.t_value = stream_item.value
+            self.t_line = stream_item.line
+            self.t_start = stream_item.start
+            self.t_end = stream_item.end
             self._offset += 1
+            if self.streaming:
+                self._trim()
 
             return stream_item
         else:
@@ -84,95 +483,162 @@ class Stream(object):
         self._block_update = True
 
     def closing_op_starts_line(self):
-        c = self.find_closing_op_offset()
-        if self.offset(c - 2)['type'] == tokenize.NL:
-            return True
-        return False
+        closer = self._closer(self._offset - 1)
+        return self._get(closer - 1).type == tokenize.NL
 
     def previous_line_ends_with(self):
         ''' returns the previous lines last token'''
-        c = 0
-        line = self.offset(c)['start'][0]
-        while self.offset(c)['start'][0] == line:
-            c -= 1
-        return self.offset(c)
+        line = self.offset(0).start[0]
+        return self._get(self.line_first[line] - 1)
 
     def closing_op_on_same_line(self):
-        cons = []
-        c = 1
-        line = self.offset(c)['start'][0]
-        while self.offset(c)['start'][0] == line:
-            t_next = self.offset(c)
-            if t_next['value'] in '({[':
-                cons.append(t_next['type'])
-            if t_next['value'] in ')}]':
-                if cons:
-                    cons = cons[:-1]
-                else:
-                    return True
-            c += 1
-        return False
+        closer = self._closer(self._offset - 1)
+        return self._get(closer).start[0] == self.offset(1).start[0]
 
     def find_closing_op_offset(self, c=0):
-        cons = [self.offset(c)['value']]
-        c += 1
-        while cons:
-            t_next = self.offset(c)
-            if t_next['value'] in '({[':
-                cons.append(t_next['value'])
-            if t_next['value'] in ')}]':
-                cons = cons[:-1]
-            c += 1
-        return c
+        ''' Get the offset of the item following the closing op that matches
+        the opening op at offset c. '''
+        return self._closer(self._offset + c - 1) - self._offset + 2
 
     def line_has_another_opener(self):
-        cons = []
-        c = 1
-        line = self.offset(c)['start'][0]
-        while self.offset(c)['start'][0] == line:
-            t_next = self.offset(c)
-            if t_next['value'] in '({[':
-                cons.append(t_next['value'])
-            if t_next['value'] in ')}]':
-                cons = cons[:-1]
-            if t_next['type'] == tokenize.NEWLINE:
-                break
-            c += 1
-        return bool(len(cons))
-
-    def next_line_starts_with(self):
-        c = 1
-        line = self.stream_offset(c)['start'][0]
-        while self.stream_offset(c)['start'][0] == line:
-            c += 1
-        return self.stream_offset(c + 1)
-
-    def line_ends_with(self):
-        c = 1
-        line = self.offset(c)['start'][0]
-        while self.offset(c)['start'][0] == line:
-            c += 1
-        return self.stream_offset(c - 1)
-
-    def closing_op_line_closing_op(self):
-        c = self.find_closing_op_offset()
-        cons = []
-        con_min = 0
-        line = self.stream_offset(c)['start'][0]
-        while self.stream_offset(c)['start'][0] == line:
-            t_next = self.stream_offset(c)
-            if t_next['value'] in '({[':
-                cons.append(t_next['type'])
-            if t_next['value'] in ')}]':
-                if cons:
-                    cons = cons[:-1]
-                else:
-                    con_min -= 1
-            c += 1
-        if con_min < 0:
-            return self.indents_current[con_min]
-        else:
+        ''' Is there an opening op after the current item on this line that
+        is not closed on it. '''
+        self._line_last(self.offset(1).start[0])
+        return self.unclosed[self._offset - self._base]
+
+
+class Pep8Report(object):
+    ''' Collects the errors found by a pep8.Checker as (line, column, code,
+    text) tuples rather than printing them. '''
+
+    def __init__(self, ignore_code):
+        self.ignore_code = ignore_code
+        self.expected = ()
+        self.errors = []
+
+    def init_file(self, filename, lines, expected, line_offset):
+        self.expected = expected or ()
+
+    def increment_logical_line(self):
+        pass
+
+    def error(self, line_number, offset, text, check):
+        code = text[:4]
+        if self.ignore_code(code) or code in self.expected:
+            return
+        self.errors.append((line_number, offset + 1, code, text[5:]))
+        return code
+
+    def get_file_results(self):
+        return len(self.errors)
+
+
+class Cache(object):
+    ''' On disk record of files known to be formatted.  Entries are keyed on
+    the file contents, the options affecting the result and the peprika
+    version.  Each entry is its own file written atomically so several
+    processes can share the cache. '''
+
+    # Options that change how files are formatted or reported
+    OPTIONS = ['kill_blank_lines', 'add_blank_lines', 'pad_blank_lines',
+               'align_indents', 'reflow_comments', 'reflow_inline_comments',
+               'fix_quotes', 'keep_whitespace', 'pep8', 'max_passes']
+    # Check the size of the cache after this many new entries
+    CHECK_SIZE = 100
+
+    def __init__(self, directory, options, size):
+        self.directory = directory
+        self.size = size
+        self.added = 0
+        fingerprint = [__version__]
+        for option in self.OPTIONS:
+            fingerprint.append('%s=%r' % (option, getattr(options, option)))
+        self.fingerprint = '\n'.join(fingerprint)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, source):
+        ''' Get the key for the source code. '''
+        import hashlib
+        key = hashlib.sha1(self.fingerprint)
+        key.update(source)
+        return key.hexdigest()
+
+    def get(self, key):
+        ''' Get the entry for the key or None. '''
+        import json
+        path = os.path.join(self.directory, key)
+        try:
+            f = open(path, 'r')
+            try:
+                entry = json.load(f)
+            finally:
+                f.close()
+            # recently used entries are evicted last
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
             return None
+        return entry
+
+    def set(self, key, entry):
+        ''' Store the entry for the key. '''
+        import json
+        path = os.path.join(self.directory, key)
+        temp = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            f = open(temp, 'w')
+            try:
+                json.dump(entry, f)
+            finally:
+                f.close()
+            os.rename(temp, path)
+        except (IOError, OSError):
+            return
+        self.added += 1
+        if self.added % self.CHECK_SIZE == 0:
+            self.evict()
+
+    def evict(self):
+        ''' Remove the least recently used entries above the cache size. '''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed by another process
+                pass
+        entries.sort()
+        for mtime, path in entries[:max(len(entries) - self.size, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class Timer(object):
+    ''' Records the wall and CPU time taken by each step of a job as
+    (name, wall, cpu) tuples. '''
+
+    def __init__(self):
+        self.steps = []
+        self.wall = time.time()
+        self.cpu = time.clock()
+
+    def step(self, name):
+        ''' The named step has just finished. '''
+        wall = time.time()
+        cpu = time.clock()
+        self.steps.append((name, wall - self.wall, cpu - self.cpu))
+        self.wall = wall
+        self.cpu = cpu
+
+    def total(self):
+        ''' Wall time taken by all the steps. '''
+        return sum(wall for name, wall, cpu in self.steps)
 
 
 class Peprika(object):
@@ -185,14 +651,55 @@ class Peprika(object):
         "'": '"',
     }
 
+    # Lines of unchanged code shown around each change in a diff.
+    DIFF_CONTEXT = 3
+    HUNK_LINE = re.compile(r'(?<=[-+])\d+')
+    # Indentation holding a tab.
+    INDENT_TAB = re.compile(r' *\t')
+
     def __init__(self, options):
         self.options = options
         self.added = 0
         self.deleted = 0
         self.errors = 0
         self.files = 0
+        self.passes = {}  # number of reformat passes needed for each file
 
         self.pep_examples = {}
+        self.pep8_options = None  # created when first needed
+        # Time taken by each step for every file and the profile of the
+        # slowest file when profiling.
+        self.profiles = []
+        self.slowest = None
+
+        self.cache = None
+        if options.cache_dir:
+            self.cache = Cache(options.cache_dir, options,
+                               options.cache_size)
+
+        # Token handlers eg _OP indexed by token type.
+        self.handler_stats = {}
+        self.handlers = {}
+        for t_type, name in tokenize.tok_name.items():
+            handler = getattr(self, '_' + name, None)
+            if handler is None:
+                continue
+            if options.handler_stats:
+                handler = self.timed_handler('_' + name, handler)
+            self.handlers[t_type] = handler
+
+    def timed_handler(self, name, handler):
+        ''' Wrap a token handler to record its calls and time taken. '''
+        stats = self.handler_stats.setdefault(name, [0, 0.0])
+
+        def timed(stream):
+            start = time.time()
+            try:
+                return handler(stream)
+            finally:
+                stats[0] += 1
+                stats[1] += time.time() - start
+        return timed
 
     def _NEWLINE(self, stream):
         self.continuation = False
@@ -241,7 +748,7 @@ class Peprika(object):
                 if '"' not in t and "'" not in t:
                     self.t_value = sp + (q * s) + t + (q * s)
         # docstrings
-        if self.stream_offset(-1)['type'] == tokenize.INDENT:
+        if self.stream_offset(-1).type == tokenize.INDENT:
             pass
             # sort white space
             # FIXME docstring changes break ast
@@ -264,8 +771,7 @@ class Peprika(object):
     def _OP(self, stream):
         # commas should be on the end of lines not at the start
         if stream.t_value == ',' and not self.line:
-            last_line = self.out[-1].rstrip(NEWLINE) + ',' + NEWLINE
-            self.out = self.out[:-1] + [last_line]
+            self.out.amend_last(self.out[-1].rstrip(NEWLINE) + ',' + NEWLINE)
             self.t_type = tokenize.NL
             return False
 
@@ -281,13 +787,13 @@ class Peprika(object):
         # if there is a space before .;: operators remove it.
         if stream.t_value in ':,;':
             if self.line and self.line[-1] == ' ':
-                self.line = self.line[:-1]
+                self.line.pop()
             self.need_space_before = False
 
         if stream.t_value in ')}]':
             if self.line and self.line[-1] == ' ':
                 if len(self.line) > 1 and self.line[-2] != ',':
-                    self.line = self.line[:-1]
+                    self.line.pop()
 
         # No space between assignments/defaults for keywords
         if stream.t_value == '=' and self.in_container():
@@ -317,8 +823,8 @@ class Peprika(object):
             before_last = stream.offset(-2)
             if (not (stream.l_type in BASIC_TOKENS
                      or (stream.l_type == tokenize.NL
-                         and (before_last['type'] in BASIC_TOKENS
-                              or before_last['value'] in ')}]'))
+                         and (before_last.type in BASIC_TOKENS
+                              or before_last.value in ')}]'))
                      or (stream.l_type == tokenize.OP
                          and stream.l_value in ')}]'))):
                 self.need_space_before = False
@@ -355,7 +861,7 @@ class Peprika(object):
                 if self.options.reflow_comments:
                     self.t_value = self.format_comment(stream.t_value)
                 if not self.block_indent:
-                    if self.previous_line_ends_with()['line'][-2:-1] == ':':
+                    if self.previous_line_ends_with().line[-2:-1] == ':':
                         self.indent_level += 1
                         self.block_indent += 1
 
@@ -376,39 +882,14 @@ class Peprika(object):
             self.supress_next_blank_line = False
 
     def scan_indent(self, update=True, start=1, break_on_nl=True):
-        ''' Scan down the token stream looking for indents/dedents we keep
-        looking to the first none blank/whitespace or comment line. '''
-        c = start
-        indent = 0
-        nl_count = 0
-        while True:
-            toktype2 = self.stream_offset(c)['type']
-            # We only indent one level at a time
-            if toktype2 == tokenize.INDENT:
-                if update:
-                    self.indent_level += 1
-                    self.block_indent += 1
-                indent += 1
-                break
-            # Dedenting can happen multiple times
-            elif toktype2 == tokenize.DEDENT:
-                if update:
-                    self.indent_level -= 1
-                    self.block_indent -= 1
-                indent -= 1
-                c += 1
-            # For multi-line comments look after the last comment
-            elif toktype2 == tokenize.NL:
-                nl_count += 1
-                if break_on_nl and nl_count == 2:
-                    break
-                c += 1
-            elif toktype2 == tokenize.COMMENT:
-                nl_count = 0
-                c += 1
-                pass
-            else:
-                break
+        ''' Look down the token stream for indents/dedents past any blank
+        lines and comments, stopping at the second blank line in a row if
+        break_on_nl.  Returns the change in indent, also applying it to the
+        indent levels if update. '''
+        indent = self.stream.indent_change(start, break_on_nl)
+        if update:
+            self.indent_level += indent
+            self.block_indent += indent
         return indent
 
     def format_comment(self, comment, remove_initial_indent=True):
@@ -426,6 +907,7 @@ class Peprika(object):
         prefix = (' ' * indent) + m.group(0) + ' '
         if not comment:
             return '#'
+        import textwrap
         comments = textwrap.wrap(comment, initial_indent=prefix,
                                  subsequent_indent=prefix)
         for l in comments[:-1]:
@@ -441,7 +923,7 @@ class Peprika(object):
         indent_last = self.indent_last
         indent_current = self.indent_current
         if indent_last:
-            c_indent = self.indents_last[indent_last - 1]
+            c_indent = self.container_last
             indent = c_indent['opening']
             if indent is None:
                 indent = c_indent['indent']
@@ -451,7 +933,7 @@ class Peprika(object):
             c_indent = None
 
         if indent_current < indent_last:
-            c_indent = self.indents_last[indent_last - 1]
+            c_indent = self.container_last
             indent = c_indent['closing']
         if self.continuation_last:
             indent += INDENT_SIZE
@@ -469,7 +951,7 @@ class Peprika(object):
             # We have to do some slightly crazy stuff after strings as they
             # claim to have nl following but don't always want one for example
             # with following ,
-            next_is_op = self.stream_offset(0)['type'] == tokenize.OP
+            next_is_op = self.stream_offset(0).type == tokenize.OP
             for i in range(1, len(t)):
                 if not next_is_op or t[i] != t[i].rstrip(NEWLINE):
                     self.out.append(t[i].rstrip(NEWLINE) + NEWLINE)
@@ -503,14 +985,6 @@ class Peprika(object):
 
     def do_newline(self):
         remainder = self.output_line()
-        self.hanging = self.hanging_current
-        self.hindent_old = self.hindent
-
-        # Add our line
-        # Update our hanging indent
-
-        self.hanging_old = self.hanging
-        self.hindent = self.hindent[:self.hanging + 1]
         self.clear_container_count = 0
         self.nl = False
         self.line = []
@@ -524,9 +998,12 @@ class Peprika(object):
         ''' Return the name of the token. '''
         return tokenize.tok_name.get(t, t)
 
-    def reformat(self, source):
-        ''' The main beast '''
-        self.stream = Stream(source)
+    def reformat(self, source, encoding='utf-8', whole_lines=False):
+        ''' The main beast.  The source lines are in the encoding and so is
+        the output, if it is None they are unicode.  whole_lines says each
+        item of the source is a single line. '''
+        self.stream = Stream(source, streaming=self.options.stream_tokens,
+                             encoding=encoding, whole_lines=whole_lines)
 
         # make some functions easier to use
         self.closing_op_starts_line = self.stream.closing_op_starts_line
@@ -536,21 +1013,13 @@ class Peprika(object):
         self.line_has_another_opener = self.stream.line_has_another_opener
         self.stream_offset = self.stream.offset
 
-        self.out = []  # Final output
+        self.out = Output()  # Final output
         self.line = []  # elements for the current line being built
         self.indent_level = 0  # Current level of indentation
         # Prevent indentation level changes when they have been
         # already processed for comments
         self.block_indent = 0
-        self.container = []  # Record of container depth for ({[
         self.clear_container_count = 0
-        # Indentation amounts for hanging elements
-        self.hindent = [{'pos': 0, 'indent': 0, 'open': True}]
-        # Indentation cache
-        self.hindent_old = [{'pos': 0, 'indent': 0, 'open': True}]
-        self.hanging = 0  # Current hanging level
-        self.hanging_old = 0  # Current hanging level
-        self.hanging_current = 0
         self.blanks = 0  # number of blank lines at the output end
         self.nl = False  # Boolean set to request a line to be output
         self.continuation = False
@@ -560,29 +1029,28 @@ class Peprika(object):
         self.last_closed_paren = None
         self.supress_next_blank_line = False
 
-        self.indents_current = []
-        self.indents_last = []
+        self.indents_current = []  # Records of the open containers ({[
+        # The innermost container open at the start of the last line, the
+        # only part of that line's containers that is looked at later.
+        self.container_last = None
         self.indent_current = 0
         self.indent_last = 0
 
         # Process the stream
         for stream_item in self.stream:
-            self.t_type = stream_item['type']
-            self.t_value = stream_item['value']
-            self.t_line = stream_item['line']
-            self.t_start = stream_item['start']
-            self.t_end = stream_item['end']
+            self.t_type = stream_item.type
+            self.t_value = stream_item.value
+            self.t_line = stream_item.line
+            self.t_start = stream_item.start
+            self.t_end = stream_item.end
 
             self.need_space_before = False
             self.need_space_after = False
 
-            name = tokenize.tok_name.get(self.t_type, self.t_type)
-            try:
-                if getattr(self, '_' + name)(self.stream) is False:
-                    self.stream.block_update()
-                    continue
-            except AttributeError:
-                pass
+            handler = self.handlers.get(self.t_type)
+            if handler and handler(self.stream) is False:
+                self.stream.block_update()
+                continue
 
             # Continuation lines
             if (not self.nl and self.stream.l_line
@@ -590,7 +1058,7 @@ class Peprika(object):
                 # only use backslash if not in a bracket etc.
                 # Also multi-line strings need to be accounted for
                 n_token = self.stream_offset(0)
-                if n_token['type'] != tokenize.STRING:
+                if n_token.type != tokenize.STRING:
                     if not self.in_container():
                         if (self.line and self.line[-1] != ' '):
                             self.line.append(' ')
@@ -611,15 +1079,12 @@ class Peprika(object):
 
             # Hanging indents need recording of where container elements start
             if self.t_value and self.t_value in '({[':
-                self.hanging_current += 1
                 self.indent_in()
             else:
                 self.clear_container_count = 0
 
             if self.t_value and self.t_value in ')}]':
                 self.indent_out()
-                self.hanging_current -= 1
-                self.container = self.container[:-1]
 
             # Newline requested
             if self.nl:
@@ -632,16 +1097,185 @@ class Peprika(object):
         self.output_line(no_blank=True)
 
         # remove any trailing blank line
-        if (self.options.kill_blank_lines
-                and self.out and not self.out[-1].strip()):
-            self.out = self.out[:-1]
+        if self.options.kill_blank_lines:
+            self.out.trim_blank_line()
 
         # convert back to string data
-        self.out = [x.encode('utf-8') for x in self.out]
-        return self.out
+        if encoding is None:
+            return self.out
+        return self.out.encode(encoding)
+
+    def reset(self):
+        ''' Drop everything kept from reformatting the last source so that
+        it can be freed while waiting for the next one. '''
+        self.stream = None
+        self.closing_op_starts_line = None
+        self.previous_line_ends_with = None
+        self.closing_op_on_same_line = None
+        self.find_closing_op_offset = None
+        self.line_has_another_opener = None
+        self.stream_offset = None
+        self.out = None
+        self.line = None
+
+    def reformat_passes(self, source, encoding='utf-8', whole_lines=False,
+                        timer=None):
+        ''' Reformat until the output no longer changes or the maximum
+        number of passes is reached.  Returns the output, the number of
+        passes made and if the output is known to no longer change.  Only
+        the source can be known to be whole lines, output lines may hold
+        several.  Each pass is a step of the timer if one is given. '''
+        passes = 0
+        while True:
+            passes += 1
+            out = self.reformat(source, encoding, whole_lines)
+            if timer:
+                timer.step('reformat %d' % passes)
+            fixed = out == source
+            if fixed or passes >= self.options.max_passes:
+                return out, passes, fixed
+            source = out
+            whole_lines = False
+
+    def reformat_lines(self, source, ranges, tree=None, whole_lines=False):
+        ''' Reformat only the top level statements that include lines in the
+        ranges, given as (first, last) line numbers.  Returns the output, the
+        most passes any statements needed and if they are all known to no
+        longer change. '''
+        if tree is None:
+            import ast
+            tree = ast.parse(''.join(source))
+        starts = statement_starts(tree, len(source))
+
+        out = []
+        passes = 0
+        fixed = True
+        done = 0  # lines of source already in the output
+        for i in range(len(starts) - 1):
+            start, end = starts[i], starts[i + 1] - 1
+            if start <= done:
+                continue
+            if not [r for r in ranges if r[0] <= end and r[1] >= start]:
+                continue
+            # Join any following statements that are also wanted
+            while i + 2 < len(starts):
+                after, after_end = starts[i + 1], starts[i + 2] - 1
+                if not [r for r in ranges
+                        if r[0] <= after_end and r[1] >= after]:
+                    break
+                end = after_end
+                i += 1
+            # Blank lines after the statements are left as they are
+            while end > start and not source[end - 1].strip():
+                end -= 1
+            out.extend(source[done:start - 1])
+            lines, statement_passes, statement_fixed = self.reformat_passes(
+                source[start - 1:end], whole_lines=whole_lines
+            )
+            out.extend(lines)
+            passes = max(passes, statement_passes)
+            fixed = fixed and statement_fixed
+            done = end
+        out.extend(source[done:])
+        return out, passes, fixed
+
+    def format_source(self, source):
+        ''' Reformat the source code checking the result is equivalent.
+        Returns the new code, or the original if it could not be reformatted,
+        and diagnostics including the time taken by each step. '''
+        import ast
+        timings = {}
+        diagnostics = {'errors': [], 'passes': 0, 'pep8': None,
+                       'timings': timings}
+        start = time.time()
+        try:
+            tree = ast.parse(source)
+        except SyntaxError as e:
+            diagnostics['errors'].append(
+                'Code has errors and was not processed: %s' % e.msg
+            )
+            return source, diagnostics
+        timings['parse'] = time.time() - start
+
+        start = time.time()
+        lines = cStringIO.StringIO(source).readlines()
+        try:
+            out, diagnostics['passes'], fixed = self.reformat_passes(
+                lines, whole_lines=True
+            )
+        except (SyntaxError, tokenize.TokenError) as e:
+            diagnostics['errors'].append(
+                'Reformatting failed so the code was left unchanged: %s'
+                % (e.args[0],)
+            )
+            return source, diagnostics
+        timings['reformat'] = time.time() - start
+
+        start = time.time()
+        if out != lines:
+            try:
+                same = same_ast(tree, ast.parse(''.join(out)))
+            except SyntaxError:
+                same = False
+            if not same:
+                diagnostics['errors'].append(
+                    'Reformatting changed the meaning of the code so it was '
+                    'left unchanged.'
+                )
+                return source, diagnostics
+        timings['check'] = time.time() - start
+
+        if self.options.pep8:
+            start = time.time()
+            diagnostics['pep8'] = self.find_pep8_errors(lines=out)
+            timings['pep8'] = time.time() - start
+        return ''.join(out), diagnostics
+
+    def format_string(self, source):
+        ''' Reformat the utf-8 source code returning the new code.  The
+        source is only decoded before and encoded after all the passes.
+        Raises SyntaxError if the code cannot be parsed and ValueError if
+        reformatting fails or would change its meaning.  Counters are not
+        updated so an instance can be used for any number of sources. '''
+        import ast
+        import codecs
+        import io
+        tree = ast.parse(source)
+        bom = ''
+        if source.startswith(codecs.BOM_UTF8):
+            bom = codecs.BOM_UTF8
+        text = source[len(bom):].decode('utf-8')
+        lines = io.StringIO(text, newline=NEWLINE).readlines()
+        try:
+            out = self.reformat_passes(lines, encoding=None,
+                                       whole_lines=True)[0]
+        except (SyntaxError, tokenize.TokenError) as e:
+            # the code parsed so this is a fault in reformatting
+            raise ValueError('Reformatting failed: %s' % (e.args[0],))
+        finally:
+            self.reset()
+        if out == lines:
+            return source
+        result = bom + u''.join(out).encode('utf-8')
+        try:
+            same = same_ast(tree, ast.parse(result))
+        except SyntaxError:
+            same = False
+        if not same:
+            raise ValueError('Reformatting changed the meaning of the code')
+        return result
+
+    def line_ranges(self, filename):
+        ''' The line ranges to reformat in the file, None for all of it. '''
+        if self.options.diff_ranges is not None:
+            return self.options.diff_ranges.get(os.path.normpath(filename),
+                                                [])
+        return self.options.line_ranges
 
     def on_newline(self):
-        self.indents_last = self.indents_current[:]
+        self.container_last = None
+        if self.indents_current:
+            self.container_last = self.indents_current[-1]
         self.indent_last = self.indent_current
         if not self.indent_current:
             self.last_indent = self.indent_level * INDENT_SIZE
@@ -682,12 +1316,12 @@ class Peprika(object):
         indent = self.last_indent
         line = self.t_start[0]
         hanging = (
-            (self.stream_offset(1)['type'] == tokenize.NL
-                or (self.stream_offset(1)['type'] != tokenize.STRING
-                    and self.stream_offset(1)['start'][0] != self.stream.l_line_no))
+            (self.stream_offset(1).type == tokenize.NL
+                or (self.stream_offset(1).type != tokenize.STRING
+                    and self.stream_offset(1).start[0] != self.stream.l_line_no))
         )
         if (self.continuation_last and level == 1 and char in '[{'
-                and self.stream_offset(1)['type'] != tokenize.NL):
+                and self.stream_offset(1).type != tokenize.NL):
             hanging = False
         closing_op_starts_line = self.closing_op_starts_line()
         indents = self.indents()
@@ -700,7 +1334,7 @@ class Peprika(object):
             opening = None
             minimum = indent
             if last and last['line'] != line:
-                if (level > 2 and self.stream_offset(-2)['value'] == ','
+                if (level > 2 and self.stream_offset(-2).value == ','
                         and last['char'] in '{['):
                     prev = self.previous_line_paren()
                     if (not (prev and prev['char'] in '{['
@@ -726,7 +1360,7 @@ class Peprika(object):
                     and not self.closing_op_on_same_line()):
                 if (char == '(' and level == 1 and self.last_closed_paren
                         and self.last_closed_paren['line'] != line
-                        and self.stream_offset(-1)['value'] == ','):
+                        and self.stream_offset(-1).value == ','):
                     pass
                     indent += INDENT_SIZE
                     closing = indent + INDENT_SIZE
@@ -736,7 +1370,7 @@ class Peprika(object):
 
             if (self.closing_op_starts_line()
                     and self.stream_offset(
-                        self.find_closing_op_offset())['value'] == ':'):
+                        self.find_closing_op_offset()).value == ':'):
                 pass
                 closing = self.last_indent
             else:
@@ -766,7 +1400,7 @@ class Peprika(object):
                     and self.last_closed_paren['line'] != line):
                 indent = self.last_closed_paren['indent'] + line_len
             if (last and last['line'] == line
-                    and self.stream_offset(-1)['value'] in '{['):
+                    and self.stream_offset(-1).value in '{['):
                 pass
                 indent = last['indent'] + 1
             opening = None
@@ -781,12 +1415,12 @@ class Peprika(object):
             if (closing_op_starts_line and level == 1 and char == '('
                     and self.stream_offset(
                         self.find_closing_op_offset()
-                    )['value'] == '\n'):
+                    ).value == '\n'):
                 pass
                 closable = True
-            if self.stream_offset(1)['value'] in '({[':
+            if self.stream_offset(1).value in '({[':
                 if self.stream_offset(self.find_closing_op_offset(1)
-                                      )['value'] not in ')}]':
+                                      ).value not in ')}]':
                     pass
                     closable = True
             elif last:
@@ -799,7 +1433,7 @@ class Peprika(object):
             if level == 1:
                 pass
         close_token = self.stream_offset(self.find_closing_op_offset() - 1)
-        line_close = close_token['start'][0],
+        line_close = close_token.start[0],
         info = dict(closing=closing,
                     opening=opening,
                     hanging=hanging,
@@ -811,11 +1445,11 @@ class Peprika(object):
                     level=level,
                     minimum=minimum,
                     closable=closable,
-                    next_char=self.stream_offset(1)['value'],
+                    next_char=self.stream_offset(1).value,
                     char=char)
         self.indents_current.append(info)
         self.indent_current += 1
-        if self.stream_offset(-1)['type'] == tokenize.NL:
+        if self.stream_offset(-1).type == tokenize.NL:
             self.on_newline()
 
     def indent_out(self):
@@ -861,105 +1495,277 @@ class Peprika(object):
         return None
 
     def indents(self):
-        c = -1
-        while True:
-            t_next = self.stream_offset(c)
-            if t_next['type'] == tokenize.NEWLINE:
-                return self.stream_offset(c - 1)['value'] == ':'
-            c += 1
+        ''' Does the current logical line end with a colon. '''
+        return self.stream.logical_line_colon(-1)
 
     def out_diff(self, filename, origional, current):
-        ''' Print out a diff between the original and generated code '''
+        ''' Print out a diff between the original and generated code and
+        count the lines added and deleted.  The diff text is only built
+        when it is to be shown. '''
+        if self.options.stats:
+            deleted, added = diff_counts(origional, current)
+            self.deleted += deleted
+            self.added += added
+        if not self.options.show_diff:
+            return
+
+        import difflib
+        from colorama import Fore, Back
         col = self.options.color_diff
-        if self.options.show_diff:
-            if col:
-                print Fore.BLUE + filename
-                print ('=' * len(filename)) + Fore.RESET
-            else:
-                print filename + '\n' + ('=' * len(filename))
+        if col:
+            print Fore.BLUE + filename
+            print ('=' * len(filename)) + Fore.RESET
+        else:
+            print filename + '\n' + ('=' * len(filename))
+
+        # Only the changed middle, with its context, goes to difflib.  The
+        # hunk line numbers are moved back to where the lines really are.
+        prefix, suffix = common_affixes(origional, current)
+        if prefix == len(origional) == len(current):
+            return
+        start = max(prefix - self.DIFF_CONTEXT, 0)
+        end = max(suffix - self.DIFF_CONTEXT, 0)
+        diff = difflib.unified_diff(origional[start:len(origional) - end],
+                                    current[start:len(current) - end],
+                                    n=self.DIFF_CONTEXT)
+
+        def shift_hunk(match):
+            return str(int(match.group()) + start)
 
         count = 0
-        for line in difflib.unified_diff(origional, current):
+        for line in diff:
             if isinstance(line, unicode):
                 line = line.encode('utf-8')
             count += 1
             if count <= 2:
                 line = line.rstrip() + '\n'
             if line[0] == '-':
-                self.deleted += 1
-                start = Fore.RED
+                start_col = Fore.RED
             elif line[0] == '+':
-                self.added += 1
-                start = Fore.GREEN
+                start_col = Fore.GREEN
             else:
-                start = u''
-            if self.options.show_diff:
-                if col and start:
-                    ln = start + line.rstrip() + Fore.RESET
-                    ln += Back.RED + line[len(line.rstrip()):-1] + Back.RESET
-                    print ln
-                else:
-                    print line[:-1]
+                start_col = u''
+                if start and line.startswith('@@'):
+                    line = self.HUNK_LINE.sub(shift_hunk, line)
+            if col and start_col:
+                ln = start_col + line.rstrip() + Fore.RESET
+                ln += Back.RED + line[len(line.rstrip()):-1] + Back.RESET
+                print ln
+            else:
+                print line[:-1]
 
     def process_file(self, filename):
+        ''' Reformat the file, recording the time taken by each step when
+        profiling. '''
+        timer = Timer()
+        profiler = None
+        if self.options.profile_dump:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            self.reformat_file(filename, timer)
+        finally:
+            if profiler:
+                profiler.disable()
+            if self.options.profile:
+                self.record_profile(filename, timer, profiler)
+
+    def reformat_file(self, filename, timer):
+        import ast
         f = open(filename, 'r')
-        data = []
-        for line in f:
-            data.append(line)
+        data = f.readlines()
+        f.close()
+        timer.step('read')
+
+        # The lines are the copy of the source kept while the file is
+        # processed, the tokens of the first pass share them.  The joined
+        # source is only kept while it is parsed.
+        source = ''.join(data)
+
+        # Files already known to be formatted need no processing
+        if self.cache:
+            key = self.cache.key(source)
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.process_cached(filename, data, entry)
+                return
         try:
-            moo2 = ast.parse(''.join(data))
+            tree = ast.parse(source)
         except Exception as e:
             err = ('File %s has errors and was not be processed: %s'
                    % (filename, e.msg))
             print >> sys.stderr, err
             self.errors += 1
             return
-        f.close()
-
-        if self.options.pep8:
-            pre_pep_errors = self.find_pep8_errors(filename=filename)
-        data_copy = data[:]
-        data = self.reformat(data)
-        # Do a second pass as sometimes this is needed
-        data = self.reformat(data)
-        moo = ast.parse(''.join(data_copy))
-
-        try:
-            moo2 = ast.parse(''.join(data))
-        except Exception:
-            self.explode(filename)
-
-        if not ast.dump(moo) == ast.dump(moo2):
-            self.explode(filename)
+        del source
+        timer.step('parse')
 
         if self.options.pep8:
+            # pep8 strips any BOM from the lines it is given
+            pre_pep_errors = self.find_pep8_errors(filename=filename,
+                                                   lines=list(data))
+            timer.step('pep8 before')
+        original = data
+        # Sometimes a second pass is needed
+        ranges = self.line_ranges(filename)
+        if ranges is None:
+            data, self.passes[filename], fixed = self.reformat_passes(
+                data, whole_lines=True, timer=timer
+            )
+        else:
+            # the passes are made for each statement so are timed together
+            data, self.passes[filename], fixed = self.reformat_lines(
+                data, ranges, tree, whole_lines=True
+            )
+            timer.step('reformat')
+
+        # Check the code still does the same thing
+        new_tree = tree
+        text = None
+        changed = data != original
+        if changed:
+            text = ''.join(data)
+            try:
+                new_tree = ast.parse(text)
+            except Exception:
+                self.explode(filename)
+
+            if not same_ast(tree, new_tree):
+                self.explode(filename)
+        timer.step('check')
+
+        if self.options.pep8 and self.options.pep8_changed:
+            post_pep_errors = self.find_changed_pep8_errors(
+                filename, original, data, pre_pep_errors, new_tree,
+                examples=True
+            )
+        elif self.options.pep8:
             post_pep_errors = self.find_pep8_errors(filename=filename,
-                                                    lines=data)
+                                                    lines=data, examples=True)
+        if self.options.pep8:
             self.output_pep8_errors(filename, pre_pep_errors, post_pep_errors,
                                     full=True)
+            timer.step('pep8 after')
+
+        # Only whole files are known to be formatted
+        if self.cache and fixed and ranges is None:
+            if changed:
+                key = self.cache.key(text)
+            self.cache.set(key, {
+                'pep8': post_pep_errors if self.options.pep8 else None
+            })
 
         if self.options.show_diff or self.options.stats:
-            self.out_diff(filename, data_copy, data)
+            self.out_diff(filename, original, data)
         if self.options.output_file:
-            print ''.join(data)
+            print ''.join(data) if text is None else text
+        timer.step('output')
 
-        if self.options.fix:
-            f = open(filename, 'w')
-            f.write(''.join(data))
-            f.close()
-        f = open('poo.py', 'w')
-        f.write(''.join(data))
-        f.close()
+        # Unchanged files are left alone so their mtime stays the same
+        if self.options.fix and changed:
+            replace_file(filename, text)
+            timer.step('write')
+
+        self.files += 1
 
+    def record_profile(self, filename, timer, profiler=None):
+        ''' Keep the time taken by each step for the file and the profile of
+        the slowest file. '''
+        self.profiles.append((filename, timer.steps))
+        if profiler is None:
+            return
+        wall = timer.total()
+        if self.slowest is None or wall > self.slowest[0]:
+            profiler.create_stats()
+            self.slowest = (wall, filename, profiler.stats)
+
+    def process_cached(self, filename, data, entry):
+        ''' Report on a file found in the cache as already formatted. '''
+        self.passes[filename] = 0
+        if self.options.pep8 and entry['pep8']:
+            errors = entry['pep8']
+            for error, info in errors['errors'].items():
+                if error not in self.pep_examples:
+                    self.pep_examples[error] = '%s %s' % (filename,
+                                                          info['desc'])
+            self.output_pep8_errors(filename, errors, errors, full=True)
+        if self.options.show_diff:
+            self.out_diff(filename, data, data)
+        if self.options.output_file:
+            print ''.join(data)
         self.files += 1
 
     def process_directory(self, directory):
-        for (dirpath, dirnames, filenames) in os.walk(directory):
-            # this is crazy
-            # so is this
-            for name in filenames:
+        filenames = []
+        for (dirpath, dirnames, names) in os.walk(directory):
+            for name in names:
                 if name.endswith('.py'):
-                    self.process_file(os.path.join(dirpath, name))
+                    filenames.append(os.path.join(dirpath, name))
+        if self.options.jobs > 1:
+            self.process_files_parallel(filenames)
+        else:
+            for filename in filenames:
+                self.process_file(filename)
+
+    def process_files_parallel(self, filenames):
+        ''' Process the files using a pool of worker processes.  The output
+        for each file is shown in order and counters merged.  A file that
+        fails is reported and counted as an error. '''
+        import multiprocessing
+        pool = multiprocessing.Pool(self.options.jobs, init_worker,
+                                    (self.options,))
+        try:
+            for filename, out, err, counters in pool.imap(process_file_job,
+                                                          filenames):
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+                self.add_counters(counters)
+        finally:
+            pool.close()
+            pool.join()
+
+    def take_counters(self):
+        ''' Return the counters collected so far and reset them. '''
+        counters = dict(added=self.added,
+                        deleted=self.deleted,
+                        errors=self.errors,
+                        files=self.files,
+                        passes=self.passes,
+                        pep_examples=self.pep_examples,
+                        profiles=self.profiles,
+                        slowest=self.slowest,
+                        handler_stats={})
+        for name, stats in self.handler_stats.items():
+            counters['handler_stats'][name] = stats[:]
+            stats[:] = [0, 0.0]
+        self.added = 0
+        self.deleted = 0
+        self.errors = 0
+        self.files = 0
+        self.passes = {}
+        self.pep_examples = {}
+        self.profiles = []
+        self.slowest = None
+        return counters
+
+    def add_counters(self, counters):
+        ''' Merge counters taken from another Peprika. '''
+        self.added += counters['added']
+        self.deleted += counters['deleted']
+        self.errors += counters['errors']
+        self.files += counters['files']
+        self.passes.update(counters['passes'])
+        for error, example in counters['pep_examples'].items():
+            self.pep_examples.setdefault(error, example)
+        self.profiles.extend(counters['profiles'])
+        slowest = counters['slowest']
+        if slowest and (self.slowest is None or slowest[0] > self.slowest[0]):
+            self.slowest = slowest
+        for name, (calls, taken) in counters['handler_stats'].items():
+            stats = self.handler_stats.setdefault(name, [0, 0.0])
+            stats[0] += calls
+            stats[1] += taken
 
     def explode(self, filename):
         msg = ['\nPeprika Error:\n\nSomething has gone very wrong formatting '
@@ -968,29 +1774,127 @@ class Peprika(object):
                'caused this error.\n']
         sys.exit(msg[0] % filename)
 
-    def find_pep8_errors(self, filename=None, lines=None):
-
-        try:
-            sys.stdout = cStringIO.StringIO()
-            checker = pep8.Checker(filename=filename, lines=lines)
-            checker.check_all()
-            output = sys.stdout.getvalue()
-        finally:
-            sys.stdout = sys.__stdout__
-
+    def find_pep8_errors(self, filename=None, lines=None, examples=False):
+        ''' Check the lines, or the file if no lines are given, with pep8.
+        Examples of each error found are recorded if requested. '''
+        return self.summarise_pep8_errors(self.check_pep8(filename, lines),
+                                          filename, examples)
+
+    def check_pep8(self, filename=None, lines=None):
+        ''' Get the pep8 errors as (line, column, code, text) tuples. '''
+        import pep8
+
+        if self.pep8_options is None:
+            self.pep8_options = pep8.StyleGuide().options
+        report = Pep8Report(self.pep8_options.ignore_code)
+        checker = pep8.Checker(filename=filename, lines=lines,
+                               options=self.pep8_options, report=report)
+        checker.check_all()
+        return report.errors
+
+    def summarise_pep8_errors(self, found, filename=None, examples=False):
         file_errors = {}
-        errors = 0
-        for line in output.split('\n'):
-            parts = line.split(' ', 2)
-            if len(parts) == 3:
-                errors += 1
-                location, error, desc = parts
-                if error not in file_errors:
-                    file_errors[error] = {'desc': desc, 'locations': []}
-                    if lines and error not in self.pep_examples:
-                        self.pep_examples[error] = '%s %s' % (filename, desc)
-                file_errors[error]['locations'].append(location)
-        return {'errors': file_errors, 'count': errors}
+        for row, col, error, desc in found:
+            if error not in file_errors:
+                file_errors[error] = {'desc': desc, 'locations': []}
+                if examples and error not in self.pep_examples:
+                    self.pep_examples[error] = '%s %s' % (filename, desc)
+            file_errors[error]['locations'].append((row, col))
+        return {'errors': file_errors, 'count': len(found), 'found': found}
+
+    def find_changed_pep8_errors(self, filename, original, lines, pre, tree,
+                                 examples=False):
+        ''' Check the reformatted lines with pep8 only looking again at the
+        statements, at any depth, that changed and the ones after them whose
+        blank line and indentation checks depend on them.  Errors for the
+        rest are taken from the check of the original.  tree is the parsed
+        reformatted code. '''
+        import ast
+
+        # pep8 expects the indentation of the first indented line so tabs in
+        # any of it can change the errors anywhere in the file.
+        tabs = self.INDENT_TAB.match
+        if ([line for line in original if tabs(line)]
+                or [line for line in lines if tabs(line)]):
+            return self.find_pep8_errors(filename, list(lines), examples)
+
+        blocks = changed_blocks(original, lines)
+        starts, parents = nested_statement_starts(tree, len(lines))
+        last_statement = len(starts) - 2
+        recheck = set()
+        for a_lo, a_hi, b_lo, b_hi in blocks:
+            # A deletion changes the line after it
+            first = bisect.bisect_right(starts, b_lo + 1) - 1
+            last = bisect.bisect_right(starts, max(b_hi, b_lo + 1)) - 1
+            recheck.update(xrange(min(first, last_statement),
+                                  min(last + 1, last_statement) + 1))
+
+        found = []
+        if recheck:
+            # Imports are only allowed before other code so the check is
+            # given the code up to the start of the first statement that is
+            # not an import.
+            prefix_end = len(lines)
+            allowed = (ast.Import, ast.ImportFrom, ast.TryExcept,
+                       ast.TryFinally, ast.Expr)
+            for node in tree.body:
+                if not isinstance(node, allowed):
+                    index = bisect.bisect_right(starts, node.lineno)
+                    prefix_end = starts[index] - 1
+                    break
+
+            # All the statements are checked at once.  Each run of them is
+            # given the statement before it, for the blank line and
+            # indentation checks, and the first line of each statement it
+            # is nested in so the indentation still tokenizes.
+            wanted = range(bisect.bisect_right(starts, prefix_end))
+            for index in sorted(recheck):
+                if index and index - 1 not in recheck:
+                    context = []
+                    parent = index - 1
+                    while parent is not None:
+                        context.append(parent)
+                        parent = parents[parent]
+                    wanted.extend(reversed(context))
+                wanted.append(index)
+            check = []
+            rows = []
+            done = -1
+            for index in wanted:
+                if index > done:
+                    start, end = starts[index], starts[index + 1]
+                    check.extend(lines[start - 1:end - 1])
+                    rows.extend(xrange(start, end))
+                    done = index
+
+            for row, col, error, desc in self.check_pep8(lines=check):
+                if error in ('E901', 'E902'):
+                    # The statements did not tokenize without the rest
+                    return self.find_pep8_errors(filename, list(lines),
+                                                 examples)
+                row = rows[row - 1]
+                if bisect.bisect_right(starts, row) - 1 not in recheck:
+                    continue
+                # Only the real end of the file has trailing blank lines
+                if row < len(lines) and error in ('W391', 'W292'):
+                    continue
+                found.append((row, col, error, desc))
+
+        # Unchanged lines keep their errors, moved by the lines added and
+        # deleted before them.
+        block_starts = [block[0] for block in blocks]
+        for row, col, error, desc in pre['found']:
+            index = bisect.bisect_right(block_starts, row - 1) - 1
+            if index >= 0:
+                a_lo, a_hi, b_lo, b_hi = blocks[index]
+                if row <= a_hi:
+                    continue
+                row += b_hi - a_hi
+            if bisect.bisect_right(starts, row) - 1 in recheck:
+                continue
+            found.append((row, col, error, desc))
+        found.sort(key=lambda error: error[0])
+        return self.summarise_pep8_errors(found, filename, examples)
 
     def output_pep8_errors(self, filename, pre, post, full=False):
         pre_errors = pre['count']
@@ -1010,6 +1914,311 @@ class Peprika(object):
                 print '%s (%s) %s' % (error, len(info['locations']),
                                       info['desc'])
 
+    def output_profile(self, count, dump=None):
+        ''' Print the steps taken by the slowest files with their wall and
+        CPU times and save the profile of the slowest file. '''
+        profiles = sorted(self.profiles,
+                          key=lambda x: -sum(step[1] for step in x[1]))
+        for filename, steps in profiles[:count]:
+            print '%s %.1fms wall %.1fms cpu' % (
+                filename, sum(step[1] for step in steps) * 1000,
+                sum(step[2] for step in steps) * 1000)
+            for name, wall, cpu in steps:
+                print '    %-12s %8.1fms wall %8.1fms cpu' % (
+                    name, wall * 1000, cpu * 1000)
+        if dump and self.slowest:
+            import marshal
+            wall, filename, stats = self.slowest
+            # the format written by cProfile.Profile.dump_stats()
+            f = open(dump, 'wb')
+            marshal.dump(stats, f)
+            f.close()
+            print 'profile of %s saved to %s' % (filename, dump)
+
+    def output_handler_stats(self):
+        ''' Print the calls and time taken by each token handler. '''
+        stats = sorted(self.handler_stats.items(), key=lambda x: -x[1][1])
+        for name, (calls, taken) in stats:
+            print '%-10s %8s calls %8.3fs' % (name, calls, taken)
+
+
+def parse_line_range(text):
+    ''' Convert text such as 120-180 or 120 to a (first, last) line range.
+    '''
+    first, sep, last = text.partition('-')
+    return int(first), int(last or first)
+
+
+def parse_diff_ranges(diff):
+    ''' Get the line ranges changed in each file of a unified diff keyed by
+    normalised filename. '''
+    ranges = {}
+    current = None
+    for line in diff:
+        if line.startswith('+++ '):
+            name = line[4:].split('\t')[0].strip()
+            if name.startswith('b/'):
+                name = name[2:]
+            current = ranges.setdefault(os.path.normpath(name), [])
+        elif line.startswith('@@') and current is not None:
+            m = re.match(r'@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', line)
+            if m:
+                first = int(m.group(1))
+                count = int(m.group(2) or 1)
+                current.append((first, first + max(count, 1) - 1))
+    return ranges
+
+
+def replace_file(filename, text):
+    ''' Replace the contents of the file with text.  The text is written to a
+    temporary file in the same directory which is renamed over the original so
+    that the file is never left partly written.  The file keeps its
+    permissions. '''
+    import tempfile
+    filename = os.path.realpath(filename)
+    directory, name = os.path.split(filename)
+    fd, temp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+                                dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        os.chmod(temp, os.stat(filename).st_mode & 07777)
+        os.rename(temp, filename)
+    except:
+        os.remove(temp)
+        raise
+
+
+# Peprika used by a worker process when processing files in parallel
+worker = None
+
+
+def init_worker(options):
+    global worker
+    worker = Peprika(options)
+
+
+def process_file_job(filename):
+    ''' Process a file in a worker process.  Returns the file's output and
+    the counters it changed. '''
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = cStringIO.StringIO()
+    sys.stderr = cStringIO.StringIO()
+    try:
+        try:
+            worker.process_file(filename)
+        except SystemExit as e:
+            # explode() aborts the run, here only the file fails
+            print >> sys.stderr, e.code
+            worker.errors += 1
+        except Exception as e:
+            print >> sys.stderr, ('File %s could not be processed: %s'
+                                  % (filename, e))
+            worker.errors += 1
+        out = sys.stdout.getvalue()
+        err = sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return filename, out, err, worker.take_counters()
+
+
+class Daemon(object):
+    ''' Keeps a warm process that reformats code for clients over a unix
+    socket.  Requests and responses are JSON, the client shuts down its side
+    of the socket once it has sent the request. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.instances = {}
+
+    def peprika(self, settings):
+        ''' Get a Peprika for the options sent by the client, reusing one
+        from earlier requests when possible. '''
+        key = tuple(sorted((name, settings[name]) for name in settings
+                           if name in Cache.OPTIONS))
+        if key not in self.instances:
+            options = Options()
+            for name, value in key:
+                setattr(options, name, value)
+            self.instances[key] = Peprika(options)
+        return self.instances[key]
+
+    def handle(self, rfile, wfile):
+        ''' Reformat the source sent by a client. '''
+        import json
+        start = time.time()
+        source = ''
+        try:
+            request = json.loads(rfile.read())
+            source = request['source'].encode('utf-8')
+            peprika = self.peprika(request.get('options', {}))
+            out, diagnostics = peprika.format_source(source)
+        except Exception as e:
+            # always answer so the client is not left without a reply
+            out = source
+            diagnostics = {'errors': ['Peprika failed so the code was left '
+                                      'unchanged: %r' % e],
+                           'passes': 0, 'pep8': None, 'timings': {}}
+        diagnostics['timings']['daemon'] = time.time() - start
+        wfile.write(json.dumps({'output': out.decode('utf-8'),
+                                'diagnostics': diagnostics}))
+
+    def serve_forever(self):
+        import socket
+        import SocketServer
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+
+            # the client may go away before its reply is written
+            def handle(self):
+                try:
+                    daemon.handle(self.rfile, self.wfile)
+                except socket.error:
+                    pass
+
+            def finish(self):
+                try:
+                    SocketServer.StreamRequestHandler.finish(self)
+                except socket.error:
+                    pass
+
+        self.prepare()
+        SocketServer.UnixStreamServer(self.path, Handler).serve_forever()
+
+    def prepare(self):
+        ''' Make the path ready to bind, exiting with an error if another
+        daemon is listening there, it is not a socket or its directory could
+        be written to by other users.  A socket left by a daemon that has
+        stopped is removed. '''
+        import socket
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.mkdir(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        problem = socket_problem(self.path)
+        if problem:
+            sys.exit(problem)
+        if not os.path.exists(self.path):
+            return
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+        except socket.error:
+            os.remove(self.path)
+        else:
+            sys.exit('A daemon is already listening on %s' % self.path)
+        finally:
+            client.close()
+
+
+def default_socket():
+    ''' The socket in a directory of the temp dir private to the user. '''
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), 'peprika-%s' % os.getuid(),
+                        'daemon.sock')
+
+
+def socket_problem(path):
+    ''' Why the socket at path, or the directory it is in, could have been
+    put there by another user or None if it cannot.  Both must belong to the
+    user and no one else may write to the directory. '''
+    import stat
+    directory = os.path.dirname(os.path.abspath(path))
+    for name in (directory, path):
+        try:
+            info = os.lstat(name)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        if info.st_uid != os.getuid():
+            return '%s belongs to another user' % name
+        if name == directory:
+            if not stat.S_ISDIR(info.st_mode):
+                return '%s is not a directory' % name
+            if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return '%s can be written to by other users' % name
+        elif not stat.S_ISSOCK(info.st_mode):
+            return '%s is not a socket' % name
+    return None
+
+
+def client_format(options, source):
+    ''' Reformat source using the daemon if one is running otherwise in
+    this process.  Returns the new code and diagnostics. '''
+    import json
+    import socket
+    problem = socket_problem(options.socket)
+    if problem:
+        # the code is not sent to a daemon that may not be the user's
+        print >> sys.stderr, 'Not using the daemon: %s' % problem
+        return Peprika(options).format_source(source)
+    settings = dict((name, getattr(options, name)) for name in Cache.OPTIONS)
+    request = json.dumps({'source': source.decode('utf-8'),
+                          'options': settings})
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(options.socket)
+        client.sendall(request)
+        client.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    except socket.error:
+        # no daemon running
+        return Peprika(options).format_source(source)
+    finally:
+        client.close()
+    try:
+        response = json.loads(''.join(data))
+    except ValueError:
+        # the daemon gave no usable reply
+        return Peprika(options).format_source(source)
+    if response['diagnostics']['errors']:
+        # the code is left as it was whatever the daemon sent back
+        return source, response['diagnostics']
+    return response['output'].encode('utf-8'), response['diagnostics']
+
+
+# Peprika instances used by format_string keyed by their formatting options
+formatters = {}
+
+
+def format_string(source, options=None):
+    ''' Reformat python source code given as a utf-8 string and return the
+    new code.  Instances are reused by later calls with the same options. '''
+    if options is None:
+        options = Options()
+    key = tuple(getattr(options, name) for name in Cache.OPTIONS)
+    if key not in formatters:
+        settings = Options()
+        for name, value in zip(Cache.OPTIONS, key):
+            setattr(settings, name, value)
+        formatters[key] = Peprika(settings)
+    return formatters[key].format_string(source)
+
+
+def output_diagnostics(filename, diagnostics, options):
+    ''' Print the diagnostics from formatting a source to stderr. '''
+    for error in diagnostics['errors']:
+        print >> sys.stderr, '%s: %s' % (filename, error)
+    if diagnostics['pep8'] and diagnostics['pep8']['count']:
+        print >> sys.stderr, '%s pep8 errors remaining %s' % (
+            filename, diagnostics['pep8']['count'])
+    if options.stats:
+        print >> sys.stderr, '%s %s' % (filename, ' '.join(
+            '%s %.1fms' % (step, taken * 1000) for step, taken
+            in sorted(diagnostics['timings'].items())))
+
 
 class Options(object):
     kill_blank_lines = True
@@ -1025,6 +2234,19 @@ class Options(object):
     keep_whitespace = False
     stats = False
     pep8 = True
+    stream_tokens = False
+    handler_stats = False
+    max_passes = 2
+    jobs = 1
+    cache_dir = None
+    cache_size = 10000
+    line_ranges = None
+    diff_ranges = None
+    socket = None
+    pep8_changed = False
+    profile = False
+    profile_files = 10  # number of slowest files to show the steps for
+    profile_dump = None
 
 '''
 keep whitespace on blank lines
@@ -1039,7 +2261,6 @@ format docstrings
 
 def main():
     options = Options()
-    peprika = Peprika(options)
 
     import argparse
     parser = argparse.ArgumentParser(description='Code reformatter for python')
@@ -1051,6 +2272,23 @@ def main():
     parser.add_argument('-p', '--pad-blanklines', action='store_true')
     parser.add_argument('-s', '--supress-new-blanklines', action='store_true')
     parser.add_argument('-k', '--keep-blanklines', action='store_true')
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--handler-stats', action='store_true')
+    parser.add_argument('--max-passes', type=int, default=2)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--cache', nargs='?', const='.peprika_cache')
+    parser.add_argument('--lines', type=parse_line_range, action='append')
+    parser.add_argument('--diff-lines', metavar='DIFF_FILE')
+    parser.add_argument('--daemon', action='store_true')
+    parser.add_argument('--client', action='store_true')
+    parser.add_argument('--stdin', action='store_true')
+    parser.add_argument('--socket')
+    parser.add_argument('--no-pep8', action='store_true')
+    parser.add_argument('--pep8-changed', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--profile-files', type=int, default=10, metavar='N')
+    parser.add_argument('--profile-dump', metavar='FILE')
     parser.add_argument('files', nargs=argparse.REMAINDER)
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-q', '--single-quote', action='store_true')
@@ -1061,16 +2299,71 @@ def main():
     options.fix = args.fix
     options.color_diff = args.color
     options.output_file = args.output
+    options.stats = args.stats
     options.kill_blank_lines = not args.keep_blanklines
     options.reflow_comments = args.reflow
     options.reflow_inline_comments = args.reflow
     options.pad_blank_lines = args.pad_blanklines
     options.add_blank_lines = not args.supress_new_blanklines
+    options.stream_tokens = args.stream
+    options.handler_stats = args.handler_stats
+    options.max_passes = args.max_passes
+    options.jobs = args.jobs
+    options.cache_dir = args.cache
+    options.line_ranges = args.lines
+    if args.diff_lines:
+        f = open(args.diff_lines, 'r')
+        options.diff_ranges = parse_diff_ranges(f)
+        f.close()
     if args.single_quote:
         options.fix_quotes = "'"
     if args.double_quote:
         options.fix_quotes = '"'
+    options.socket = args.socket or default_socket()
+    options.pep8 = not args.no_pep8
+    options.pep8_changed = args.pep8_changed
+    options.profile = args.profile or bool(args.profile_dump)
+    options.profile_files = args.profile_files
+    options.profile_dump = args.profile_dump
+
+    if args.daemon:
+        Daemon(options.socket).serve_forever()
+        return
+
+    if args.stdin or args.files == ['-']:
+        # Work as a filter, only the code goes to stdout
+        source = sys.stdin.read()
+        if args.client:
+            out, diagnostics = client_format(options, source)
+        else:
+            out, diagnostics = Peprika(options).format_source(source)
+        output_diagnostics('<stdin>', diagnostics, options)
+        sys.stdout.write(out)
+        if diagnostics['errors']:
+            # the code was passed through unchanged
+            sys.exit(1)
+        return
+
+    if args.client:
+        failed = False
+        for filename in args.files:
+            f = open(filename, 'r')
+            source = f.read()
+            f.close()
+            out, diagnostics = client_format(options, source)
+            output_diagnostics(filename, diagnostics, options)
+            if diagnostics['errors']:
+                failed = True
+            if options.fix:
+                if out != source:
+                    replace_file(filename, out)
+            else:
+                sys.stdout.write(out)
+        if failed:
+            sys.exit(1)
+        return
 
+    peprika = Peprika(options)
     for filename in args.files:
         if os.path.isdir(filename):
             peprika.process_directory(filename)
@@ -1082,6 +2375,15 @@ def main():
         print '%s errors' % peprika.errors
         print '%s lines added' % peprika.added
         print '%s lines deleted' % peprika.deleted
+        passes = peprika.passes.values()
+        for count in sorted(set(passes)):
+            print '%s files took %s passes' % (passes.count(count), count)
+
+    if options.handler_stats:
+        peprika.output_handler_stats()
+
+    if options.profile:
+        peprika.output_profile(options.profile_files, options.profile_dump)
 
     print '-' * 30
     for key, item in peprika.pep_examples.iteritems():